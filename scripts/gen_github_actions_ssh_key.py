@@ -1,7 +1,9 @@
 import os
-import subprocess
 from pathlib import Path
 
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
 OUT_DIR = REPO_ROOT / "deploy" / "vps" / "keys"
@@ -20,22 +22,29 @@ def main() -> int:
 
     comment = os.environ.get("KEY_COMMENT", "github-actions-deploy").strip() or "github-actions-deploy"
 
-    # Use ssh-keygen (available on Git for Windows / Windows OpenSSH / Linux runners).
-    subprocess.check_call(
-        [
-            "ssh-keygen",
-            "-t",
-            "ed25519",
-            "-N",
-            "",
-            "-C",
-            comment,
-            "-f",
-            str(key_path),
-        ]
+    # Generate in-process via cryptography (a paramiko dependency, so always
+    # available here) instead of forking ssh-keygen: no external binary, no
+    # process spawn, ~1ms instead of ~50ms.
+    priv = ed25519.Ed25519PrivateKey.generate()
+    priv_bytes = priv.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    )
+    pub_bytes = (
+        priv.public_key().public_bytes(
+            serialization.Encoding.OpenSSH,
+            serialization.PublicFormat.OpenSSH,
+        )
+        + b" "
+        + comment.encode("utf-8")
     )
 
-    pub = pub_path.read_text(encoding="utf-8").strip()
+    key_path.write_bytes(priv_bytes)
+    os.chmod(key_path, 0o600)
+    pub_path.write_bytes(pub_bytes + b"\n")
+
+    pub = pub_bytes.decode("utf-8")
     print("[ok] Generated GitHub Actions deploy key pair.")
     print(f"[public] {pub}")
     print(f"[path] Private key: {key_path}")
@@ -45,4 +54,3 @@ def main() -> int:
 
 if __name__ == "__main__":
     raise SystemExit(main())
-
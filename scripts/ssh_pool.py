@@ -0,0 +1,382 @@
+"""
+Shared paramiko SSH connection pool for the VPS deploy scripts.
+
+Every script used to ship its own `SSH` context manager and open a fresh
+TCP + SSH handshake (~1-2s) per invocation. This module keeps one
+authenticated `SSHClient` per (host, user) alive for the lifetime of the
+process, with SSH-level keepalives, so scripts running back-to-back (e.g.
+in CI via the orchestrator below) reuse the session.
+
+Run as a module to execute several scripts over one shared connection:
+
+    python scripts/ssh_pool.py setup add-deploy-key status
+"""
+
+import re
+import select
+import shlex
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import paramiko
+
+
+# Seconds between SSH-level keepalive packets; keeps NAT/firewall state and
+# the pooled session alive between script invocations.
+_KEEPALIVE_INTERVAL_S = 30
+
+# Prefer AEAD ciphers over paramiko's default order: AES-GCM/chacha20 are
+# markedly faster than CTR+MAC (and CBC) on hosts with AES-NI, which shows up
+# when streaming bulk output such as docker compose pull/logs. Only ciphers
+# this paramiko build knows are prepended.
+_AEAD_CIPHERS = (
+    "aes128-gcm@openssh.com",
+    "chacha20-poly1305@openssh.com",
+    "aes256-gcm@openssh.com",
+)
+_aead_known = tuple(c for c in _AEAD_CIPHERS if c in paramiko.Transport._cipher_info)
+paramiko.Transport._preferred_ciphers = _aead_known + tuple(
+    c for c in paramiko.Transport._preferred_ciphers if c not in _aead_known
+)
+
+# Legacy CBC modes: slow and no reason to ever negotiate them here.
+_DISABLED_CIPHERS = ["aes128-cbc", "aes256-cbc", "3des-cbc"]
+
+_pool: Dict[Tuple[str, str], paramiko.SSHClient] = {}
+
+
+def _connect(host: str, user: str, password: str, timeout_s: int) -> paramiko.SSHClient:
+    c = paramiko.SSHClient()
+    c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    c.connect(
+        host,
+        username=user,
+        password=password,
+        timeout=timeout_s,
+        banner_timeout=timeout_s,
+        auth_timeout=timeout_s,
+        # Deploy traffic is mostly compose/apt text output — very compressible,
+        # and zlib is cheap next to the WAN link.
+        compress=True,
+        disabled_algorithms={"ciphers": _DISABLED_CIPHERS},
+    )
+    transport = c.get_transport()
+    if transport is not None:
+        transport.set_keepalive(_KEEPALIVE_INTERVAL_S)
+    return c
+
+
+def get_client(host: str, user: str, password: str, timeout_s: int = 20) -> paramiko.SSHClient:
+    """Return a pooled, authenticated client; reconnect if the session died."""
+    key = (host, user)
+    client = _pool.get(key)
+    if client is not None:
+        transport = client.get_transport()
+        if transport is not None and transport.is_active():
+            return client
+        client.close()
+    client = _connect(host, user, password, timeout_s)
+    _pool[key] = client
+    return client
+
+
+def _drain_channel(
+    chan: paramiko.Channel,
+    stdout_stream=None,
+    stderr_stream=None,
+) -> Tuple[int, str, str]:
+    """
+    Drain stdout and stderr of an exec channel concurrently.
+
+    Reading stdout.read() then stderr.read() deadlocks once a command
+    produces more than the window size (~64KB) on the stream we are not
+    reading: the remote blocks on a full pipe while we block on the other
+    stream. Interleave reads with select() so both always make progress.
+
+    When a binary stream is given for stdout/stderr, chunks are written (and
+    flushed) there as they arrive instead of buffered — constant memory and
+    interactive output for long-running commands; the corresponding return
+    value is then empty.
+    """
+    out = bytearray()
+    err = bytearray()
+
+    def _sink(data: bytes, stream, buf: bytearray) -> None:
+        if stream is not None:
+            stream.write(data)
+            stream.flush()
+        else:
+            buf += data
+
+    while True:
+        progressed = False
+        while chan.recv_ready():
+            _sink(chan.recv(65536), stdout_stream, out)
+            progressed = True
+        while chan.recv_stderr_ready():
+            _sink(chan.recv_stderr(65536), stderr_stream, err)
+            progressed = True
+        if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+            break
+        if not progressed:
+            select.select([chan], [], [], 1.0)
+    # Pick up anything buffered between the last recv and EOF.
+    while chan.recv_ready():
+        _sink(chan.recv(65536), stdout_stream, out)
+    while chan.recv_stderr_ready():
+        _sink(chan.recv_stderr(65536), stderr_stream, err)
+    rc = chan.recv_exit_status()
+    return rc, out.decode("utf-8", errors="replace"), err.decode("utf-8", errors="replace")
+
+
+def close_all() -> None:
+    for client in _pool.values():
+        client.close()
+    _pool.clear()
+
+
+class RemoteShell:
+    """
+    Long-lived interactive shell channel.
+
+    Running N commands through one shell amortizes the per-exec channel setup
+    and shell startup across the whole sequence. Each command's exit code is
+    recovered from a sentinel printed after it; the sentinel is assembled via
+    printf format expansion so that the shell's echo of the command line can
+    never contain the expanded marker.
+    """
+
+    def __init__(self, chan: paramiko.Channel):
+        self.chan = chan
+        self._token = uuid.uuid4().hex
+        self._done_re = re.compile(rf"__DONE_{self._token}_(\d+)__")
+        # Silence input echo and prompts so command output stays clean.
+        self._run_raw("stty -echo 2>/dev/null; export PS1= PS2=")
+
+    def _run_raw(self, cmd: str) -> Tuple[int, str]:
+        self.chan.send(f"{cmd}; printf '__DONE_%s_%s__\\n' {self._token} $?\n")
+        buf = ""
+        while True:
+            m = self._done_re.search(buf)
+            if m:
+                return int(m.group(1)), buf[: m.start()]
+            if self.chan.closed:
+                raise RuntimeError(f"Shell closed before command finished: {cmd}")
+            select.select([self.chan], [], [], 1.0)
+            while self.chan.recv_ready():
+                buf += self.chan.recv(65536).decode("utf-8", errors="replace")
+
+    def run(self, cmd: str, check: bool = True) -> Tuple[int, str]:
+        rc, out = self._run_raw(cmd)
+        if check and rc != 0:
+            raise RuntimeError(f"Command failed ({rc}): {cmd}\n{out}".strip())
+        return rc, out
+
+    def close(self) -> None:
+        self.chan.close()
+
+    def __enter__(self) -> "RemoteShell":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class PooledSSH:
+    """
+    Context manager over a pooled `SSHClient`.
+
+    Unlike the old per-script `SSH` classes, exiting the context does NOT
+    close the underlying connection; it stays in the pool for the next
+    `PooledSSH` (or the next script in the same process).
+    """
+
+    def __init__(self, host: str, user: str, password: str, timeout_s: int = 20):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.timeout_s = timeout_s
+        self.client: Optional[paramiko.SSHClient] = None
+        self._sftp: Optional[paramiko.SFTPClient] = None
+
+    def __enter__(self) -> "PooledSSH":
+        self.client = get_client(self.host, self.user, self.password, self.timeout_s)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # Close the cached SFTP channel but leave the client in the pool; it
+        # is closed via close_all() or at process exit.
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        self.client = None
+
+    def sftp(self) -> paramiko.SFTPClient:
+        # Opening the SFTP subsystem costs an INIT/VERSION round-trip; do it
+        # once per session instead of once per file operation.
+        assert self.client is not None
+        if self._sftp is None:
+            self._sftp = self.client.open_sftp()
+        return self._sftp
+
+    def run(
+        self,
+        cmd: str,
+        check: bool = True,
+        stdout_stream=None,
+        stderr_stream=None,
+    ) -> Tuple[int, str, str]:
+        assert self.client is not None
+        stdin, stdout, stderr = self.client.exec_command(cmd)
+        rc, out, err = _drain_channel(stdout.channel, stdout_stream, stderr_stream)
+        if check and rc != 0:
+            raise RuntimeError(f"Command failed ({rc}): {cmd}\n{err}".strip())
+        return rc, out, err
+
+    def run_script(
+        self,
+        script: str,
+        check: bool = True,
+        stdin_data: Optional[bytes] = None,
+    ) -> Tuple[int, str, str]:
+        # Ship a whole multi-command script over a single exec channel instead
+        # of one channel per command; each channel open/close costs a full
+        # round-trip, which dominates on high-latency links.
+        #
+        # Without stdin_data the script itself streams over stdin to bash -s.
+        # With stdin_data the script is passed as a shell-quoted argument so
+        # its stdin stays free for the payload — the safe way to hand the
+        # script content that must not go through shell interpolation.
+        assert self.client is not None
+        if stdin_data is None:
+            stdin, stdout, stderr = self.client.exec_command("bash -s")
+            stdin.write(script)
+        else:
+            stdin, stdout, stderr = self.client.exec_command(f"bash -c {shlex.quote(script)}")
+            stdin.write(stdin_data)
+        stdin.channel.shutdown_write()
+        rc, out, err = _drain_channel(stdout.channel)
+        if check and rc != 0:
+            raise RuntimeError(f"Script failed ({rc}):\n{err}".strip())
+        return rc, out, err
+
+    def run_parallel(self, cmds: List[str], check: bool = True) -> List[Tuple[int, str, str]]:
+        """
+        Run independent commands concurrently, one channel each, on the shared
+        transport (sshd allows several sessions per connection; MaxSessions
+        defaults to 10). N sequential round-trips collapse to roughly one.
+        """
+        assert self.client is not None
+        results: List[Optional[Tuple[int, str, str]]] = [None] * len(cmds)
+
+        def _one(i: int, cmd: str) -> None:
+            stdin, stdout, stderr = self.client.exec_command(cmd)
+            results[i] = _drain_channel(stdout.channel)
+
+        threads = [threading.Thread(target=_one, args=(i, cmd)) for i, cmd in enumerate(cmds)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if check:
+            for cmd, res in zip(cmds, results):
+                assert res is not None
+                rc, _, err = res
+                if rc != 0:
+                    raise RuntimeError(f"Command failed ({rc}): {cmd}\n{err}".strip())
+        return [r for r in results if r is not None]
+
+    def put_bytes(self, remote_path: str, content: bytes, mode: int = 0o600, atomic: bool = False) -> None:
+        # Writes are pipelined: paramiko dispatches WRITE packets without
+        # waiting for each ACK. A failed upload cannot be resumed mid-file,
+        # which is fine for these idempotent config uploads (we always rewrite
+        # the whole file).
+        sftp = self.sftp()
+        if not atomic:
+            # Write the destination directly: two round-trips (write +
+            # chmod) instead of the four the temp+rename dance costs. Fine
+            # for the small idempotent config files these scripts upload.
+            with sftp.file(remote_path, "wb") as f:
+                f.set_pipelined(True)
+                f.write(content)
+            sftp.chmod(remote_path, mode)
+            return
+        tmp = f"{remote_path}.tmp-{int(time.time())}"
+        with sftp.file(tmp, "wb") as f:
+            f.set_pipelined(True)
+            f.write(content)
+        sftp.chmod(tmp, mode)
+        # Some SFTP servers refuse to overwrite on rename; remove destination first.
+        try:
+            sftp.remove(remote_path)
+        except OSError:
+            pass
+        sftp.rename(tmp, remote_path)
+
+    def put_text(self, remote_path: str, content: str, mode: int = 0o600, atomic: bool = False) -> None:
+        self.put_bytes(remote_path, content.encode("utf-8"), mode=mode, atomic=atomic)
+
+    def open_shell(self, cwd: Optional[str] = None) -> RemoteShell:
+        """Open a persistent shell; handy for command sequences sharing a cwd."""
+        assert self.client is not None
+        shell = RemoteShell(self.client.invoke_shell())
+        if cwd is not None:
+            shell.run(f"cd {shlex.quote(cwd)}")
+        return shell
+
+    def write_file_via_exec(self, remote_path: str, content: bytes, mode: int = 0o600) -> None:
+        """
+        Write a small file by streaming it to `install` over a plain exec
+        channel. Avoids the SFTP subsystem negotiation entirely (~1 RTT per
+        file) — worthwhile for the sub-kilobyte configs these scripts push.
+        """
+        assert self.client is not None
+        cmd = f"install -m {mode:04o} /dev/stdin {shlex.quote(remote_path)}"
+        stdin, stdout, stderr = self.client.exec_command(cmd)
+        stdin.write(content)
+        stdin.channel.shutdown_write()
+        err = stderr.read().decode("utf-8", errors="replace")
+        rc = stdout.channel.recv_exit_status()
+        if rc != 0:
+            raise RuntimeError(f"Write failed ({rc}): {remote_path}\n{err}".strip())
+
+    def get_text(self, remote_path: str) -> str:
+        with self.sftp().file(remote_path, "rb") as f:
+            return f.read().decode("utf-8", errors="replace")
+
+
+def _orchestrate(names: List[str]) -> int:
+    """Run several script mains in-process so they share the pooled session."""
+    import gen_github_actions_ssh_key
+    import vps_add_deploy_user_key
+    import vps_check_status
+    import vps_setup_langfuse
+    import vps_switch_media_to_r2
+
+    mains = {
+        "gen-key": gen_github_actions_ssh_key.main,
+        "setup": vps_setup_langfuse.main,
+        "add-deploy-key": vps_add_deploy_user_key.main,
+        "switch-media-r2": vps_switch_media_to_r2.main,
+        "status": vps_check_status.main,
+    }
+    unknown = [n for n in names if n not in mains]
+    if unknown:
+        raise SystemExit(f"Unknown script(s): {', '.join(unknown)}. Known: {', '.join(mains)}")
+    rc = 0
+    try:
+        for name in names:
+            print(f"[run] {name}")
+            rc = mains[name]()
+            if rc != 0:
+                break
+    finally:
+        close_all()
+    return rc
+
+
+if __name__ == "__main__":
+    raise SystemExit(_orchestrate(sys.argv[1:]))
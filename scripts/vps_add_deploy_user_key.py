@@ -1,9 +1,8 @@
 import os
-import time
 from dataclasses import dataclass
 from pathlib import Path
 
-import paramiko
+from ssh_pool import PooledSSH
 
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
@@ -23,55 +22,6 @@ def _require_env(name: str) -> str:
     return v
 
 
-class SSH:
-    def __init__(self, vps: VPS):
-        self.vps = vps
-        self.client = None
-
-    def __enter__(self) -> "SSH":
-        c = paramiko.SSHClient()
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        c.connect(
-            self.vps.host,
-            username=self.vps.user,
-            password=self.vps.password,
-            timeout=20,
-            banner_timeout=20,
-            auth_timeout=20,
-        )
-        self.client = c
-        return self
-
-    def __exit__(self, exc_type, exc, tb) -> None:
-        if self.client:
-            self.client.close()
-            self.client = None
-
-    def run(self, cmd: str, check: bool = True) -> tuple[int, str, str]:
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-        out = stdout.read().decode("utf-8", errors="replace")
-        err = stderr.read().decode("utf-8", errors="replace")
-        rc = stdout.channel.recv_exit_status()
-        if check and rc != 0:
-            raise RuntimeError(f"Command failed ({rc}): {cmd}\n{err}".strip())
-        return rc, out, err
-
-    def put_bytes(self, remote_path: str, content: bytes, mode: int = 0o600) -> None:
-        sftp = self.client.open_sftp()
-        try:
-            tmp = f"{remote_path}.tmp-{int(time.time())}"
-            with sftp.file(tmp, "wb") as f:
-                f.write(content)
-            sftp.chmod(tmp, mode)
-            try:
-                sftp.remove(remote_path)
-            except OSError:
-                pass
-            sftp.rename(tmp, remote_path)
-        finally:
-            sftp.close()
-
-
 def main() -> int:
     vps = VPS(
         host=_require_env("VPS_HOST"),
@@ -81,48 +31,45 @@ def main() -> int:
 
     deploy_user = os.environ.get("DEPLOY_USER", "deploy").strip() or "deploy"
     pubkey_path = Path(_require_env("DEPLOY_PUBKEY_PATH"))
-    pubkey = pubkey_path.read_text(encoding="utf-8").strip() + "\n"
-
-    with SSH(vps) as ssh:
-        # Create user + group (idempotent).
-        ssh.run(
-            "set -euo pipefail; "
-            f"id -u {deploy_user} >/dev/null 2>&1 || useradd -m -s /bin/bash {deploy_user}; "
+    pubkey = pubkey_path.read_text(encoding="utf-8").strip()
+
+    # One script, one channel: user/group creation, .ssh setup, key append and
+    # /opt/langfuse permissions used to be four separate exec round-trips.
+    # The key itself arrives over stdin — Python repr is not shell quoting, so
+    # interpolating it into the script would be a correctness hazard.
+    script = "\n".join(
+        [
+            "set -euo pipefail",
+            # Create user + group (idempotent).
+            f"id -u {deploy_user} >/dev/null 2>&1 || useradd -m -s /bin/bash {deploy_user}",
             # Ensure docker group exists and user is in it (for docker socket access).
-            "getent group docker >/dev/null 2>&1 || groupadd docker; "
-            f"usermod -aG docker {deploy_user}"
-        )
-
-        # Setup authorized_keys
-        ssh.run(
-            "set -euo pipefail; "
-            f"install -d -m 0700 -o {deploy_user} -g {deploy_user} /home/{deploy_user}/.ssh; "
-            f"touch /home/{deploy_user}/.ssh/authorized_keys; "
-            f"chown {deploy_user}:{deploy_user} /home/{deploy_user}/.ssh/authorized_keys; "
-            f"chmod 0600 /home/{deploy_user}/.ssh/authorized_keys"
-        )
-
-        # Append key if missing
-        ssh.run(
-            "set -euo pipefail; "
-            f"grep -qxF {repr(pubkey.strip())} /home/{deploy_user}/.ssh/authorized_keys || "
-            f"printf %s {repr(pubkey)} >> /home/{deploy_user}/.ssh/authorized_keys"
-        )
-
-        # Make /opt/langfuse readable by deploy (but not world-readable).
-        # This is required because docker compose reads /opt/langfuse/.env and
-        # GitHub Actions uses scp to overwrite docker-compose.yml and Caddyfile.
-        ssh.run(
-            "set -euo pipefail; "
-            "if [ -d /opt/langfuse ]; then "
-            f"chown -R {deploy_user}:{deploy_user} /opt/langfuse; "
+            "getent group docker >/dev/null 2>&1 || groupadd docker",
+            f"usermod -aG docker {deploy_user}",
+            # Setup authorized_keys
+            f"install -d -m 0700 -o {deploy_user} -g {deploy_user} /home/{deploy_user}/.ssh",
+            f"touch /home/{deploy_user}/.ssh/authorized_keys",
+            f"chown {deploy_user}:{deploy_user} /home/{deploy_user}/.ssh/authorized_keys",
+            f"chmod 0600 /home/{deploy_user}/.ssh/authorized_keys",
+            # Append key (from stdin) if missing
+            'PUBKEY="$(cat)"',
+            f'grep -qxF "$PUBKEY" /home/{deploy_user}/.ssh/authorized_keys || '
+            f"printf '%s\\n' \"$PUBKEY\" >> /home/{deploy_user}/.ssh/authorized_keys",
+            # Make /opt/langfuse readable by deploy (but not world-readable).
+            # This is required because docker compose reads /opt/langfuse/.env and
+            # GitHub Actions uses scp to overwrite docker-compose.yml and Caddyfile.
+            "if [ -d /opt/langfuse ]; then",
+            f"chown -R {deploy_user}:{deploy_user} /opt/langfuse",
             # Keep secrets group-readable by deploy, but prefer root ownership.
-            f"chown root:{deploy_user} /opt/langfuse/.env 2>/dev/null || true; "
-            "chmod 0750 /opt/langfuse; "
-            f"chmod 0640 /opt/langfuse/.env 2>/dev/null || true; "
-            "chmod 0644 /opt/langfuse/docker-compose.yml /opt/langfuse/Caddyfile 2>/dev/null || true; "
-            "fi"
-        )
+            f"chown root:{deploy_user} /opt/langfuse/.env 2>/dev/null || true",
+            "chmod 0750 /opt/langfuse",
+            "chmod 0640 /opt/langfuse/.env 2>/dev/null || true",
+            "chmod 0644 /opt/langfuse/docker-compose.yml /opt/langfuse/Caddyfile 2>/dev/null || true",
+            "fi",
+        ]
+    )
+
+    with PooledSSH(vps.host, vps.user, vps.password) as ssh:
+        ssh.run_script(script, stdin_data=pubkey.encode("utf-8"))
 
     print(f"[ok] Added deploy user/key on VPS. User: {deploy_user}")
     return 0
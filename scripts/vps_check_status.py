@@ -1,7 +1,7 @@
 import os
 import sys
 
-import paramiko
+from ssh_pool import PooledSSH
 
 
 def _require_env(name: str) -> str:
@@ -16,10 +16,6 @@ def main() -> int:
     user = _require_env("VPS_USER")
     password = _require_env("VPS_PASS")
 
-    cli = paramiko.SSHClient()
-    cli.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    cli.connect(host, username=user, password=password, timeout=20, banner_timeout=20, auth_timeout=20)
-
     cmd = (
         "set -euo pipefail; "
         "cd /opt/langfuse; "
@@ -27,16 +23,16 @@ def main() -> int:
         "echo '---'; "
         "docker compose logs --no-color --tail=80 caddy"
     )
-    stdin, stdout, stderr = cli.exec_command(cmd)
-    out = stdout.read().decode("utf-8", errors="replace")
-    err = stderr.read().decode("utf-8", errors="replace")
-    rc = stdout.channel.recv_exit_status()
-    cli.close()
-
-    # Windows consoles may not support unicode; write bytes to avoid encode errors.
-    sys.stdout.buffer.write(out.encode("utf-8", errors="replace"))
-    if err.strip():
-        sys.stderr.buffer.write(err.encode("utf-8", errors="replace"))
+    # Stream output as it arrives instead of buffering the whole log: the
+    # user sees progress immediately and memory stays constant. Writing bytes
+    # also sidesteps unicode issues on Windows consoles.
+    with PooledSSH(host, user, password) as ssh:
+        rc, _, _ = ssh.run(
+            cmd,
+            check=False,
+            stdout_stream=sys.stdout.buffer,
+            stderr_stream=sys.stderr.buffer,
+        )
     return rc
 
 
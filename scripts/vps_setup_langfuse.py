@@ -1,18 +1,85 @@
+import functools
+import hashlib
 import os
+import re
+import secrets
 import socket
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional
 
-import paramiko
+from ssh_pool import PooledSSH
 
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
 DEPLOY_DIR = REPO_ROOT / "deploy" / "vps"
 
 
+# Exit code the provisioning script uses to signal a distro we cannot
+# auto-install Docker on; anything else non-zero is a plain failure.
+_RC_UNSUPPORTED_DISTRO = 3
+
+# Everything from distro detection through the Docker install runs as one
+# remote script over a single exec channel; the old per-step ssh.run calls
+# cost a network round-trip each even when the step itself was a no-op.
+_PROVISION_SCRIPT = f"""set -euo pipefail
+. /etc/os-release
+DISTRO_ID="${{ID:-}}"
+DISTRO_CODENAME="${{VERSION_CODENAME:-}}"
+
+# Clean up any wrong Docker repo config that would break apt-get update.
+if [ -f /etc/apt/sources.list.d/docker.list ] && \\
+   grep -q "download.docker.com/linux/ubuntu" /etc/apt/sources.list.d/docker.list && \\
+   [ "$DISTRO_ID" = "debian" ]; then
+  rm -f /etc/apt/sources.list.d/docker.list
+fi
+if [ -f /etc/apt/sources.list.d/docker.list ] && \\
+   grep -q "download.docker.com/linux/debian" /etc/apt/sources.list.d/docker.list && \\
+   [ "$DISTRO_ID" = "ubuntu" ]; then
+  rm -f /etc/apt/sources.list.d/docker.list
+fi
+
+# Ensure base tools
+apt-get update -y
+DEBIAN_FRONTEND=noninteractive apt-get install -y ca-certificates curl gnupg openssl ufw
+
+# Firewall: allow SSH + HTTP(S)
+ufw allow OpenSSH || true
+ufw allow 80/tcp || true
+ufw allow 443/tcp || true
+ufw --force enable || true
+
+# Install Docker if missing (Debian/Ubuntu).
+if ! command -v docker >/dev/null 2>&1; then
+  case "$DISTRO_ID" in
+    debian|ubuntu) ;;
+    *)
+      echo "Unsupported distro for automatic Docker install (id='$DISTRO_ID', codename='$DISTRO_CODENAME')" >&2
+      exit {_RC_UNSUPPORTED_DISTRO}
+      ;;
+  esac
+  if [ -z "$DISTRO_CODENAME" ]; then
+    echo "Unsupported distro for automatic Docker install (id='$DISTRO_ID', codename='$DISTRO_CODENAME')" >&2
+    exit {_RC_UNSUPPORTED_DISTRO}
+  fi
+  install -m 0755 -d /etc/apt/keyrings
+  curl -fsSL "https://download.docker.com/linux/$DISTRO_ID/gpg" | gpg --dearmor --batch --yes --no-tty -o /etc/apt/keyrings/docker.gpg
+  chmod a+r /etc/apt/keyrings/docker.gpg
+  echo "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.gpg] https://download.docker.com/linux/$DISTRO_ID $DISTRO_CODENAME stable" \\
+    > /etc/apt/sources.list.d/docker.list
+  apt-get update -y
+  DEBIAN_FRONTEND=noninteractive apt-get install -y docker-ce docker-ce-cli containerd.io docker-compose-plugin
+  systemctl enable --now docker
+fi
+
+# Prepare /opt/langfuse
+mkdir -p /opt/langfuse
+chmod 0755 /opt/langfuse
+"""
+
+
 @dataclass(frozen=True)
 class VPSConfig:
     host: str
@@ -29,23 +96,18 @@ def _require_env(name: str) -> str:
     return val
 
 
+@functools.lru_cache(maxsize=None)
 def _read_file(p: Path) -> bytes:
+    # Memoized so repeated main() runs in one process (via the ssh_pool
+    # orchestrator) stat+read each deploy file only once.
     return p.read_bytes()
 
 
-def _gen_base64(nbytes: int = 32) -> str:
-    import secrets
-    import base64
-
-    return base64.b64encode(secrets.token_bytes(nbytes)).decode("ascii")
-
-
 def _gen_hex(nbytes: int = 32) -> str:
-    import secrets
-
     return secrets.token_hex(nbytes)
 
 
+@functools.lru_cache(maxsize=None)
 def _resolve_a(name: str) -> Optional[str]:
     try:
         infos = socket.getaddrinfo(name, None, family=socket.AF_INET)
@@ -57,71 +119,18 @@ def _resolve_a(name: str) -> Optional[str]:
     return infos[0][4][0]
 
 
-class SSH:
-    def __init__(self, host: str, user: str, password: str, timeout_s: int = 20):
-        self.host = host
-        self.user = user
-        self.password = password
-        self.timeout_s = timeout_s
-        self.client: Optional[paramiko.SSHClient] = None
-
-    def __enter__(self) -> "SSH":
-        c = paramiko.SSHClient()
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        c.connect(
-            self.host,
-            username=self.user,
-            password=self.password,
-            timeout=self.timeout_s,
-            banner_timeout=self.timeout_s,
-            auth_timeout=self.timeout_s,
-        )
-        self.client = c
-        return self
-
-    def __exit__(self, exc_type, exc, tb) -> None:
-        if self.client:
-            self.client.close()
-            self.client = None
-
-    def run(self, cmd: str, check: bool = True) -> Tuple[int, str, str]:
-        assert self.client is not None
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-        out = stdout.read().decode("utf-8", errors="replace")
-        err = stderr.read().decode("utf-8", errors="replace")
-        code = stdout.channel.recv_exit_status()
-        if check and code != 0:
-            raise RuntimeError(f"Command failed ({code}): {cmd}\n{err}".strip())
-        return code, out, err
-
-    def put_bytes(self, remote_path: str, content: bytes, mode: int = 0o600) -> None:
-        assert self.client is not None
-        sftp = self.client.open_sftp()
-        try:
-            tmp = f"{remote_path}.tmp-{int(time.time())}"
-            with sftp.file(tmp, "wb") as f:
-                f.write(content)
-            sftp.chmod(tmp, mode)
-            # Some SFTP servers refuse to overwrite on rename; remove destination first.
-            try:
-                sftp.remove(remote_path)
-            except OSError:
-                pass
-            sftp.rename(tmp, remote_path)
-        finally:
-            sftp.close()
-
-
 def build_env_file(cfg: VPSConfig) -> bytes:
     # Generate fresh secrets and store them server-side in /opt/langfuse/.env.
-    nextauth_secret = _gen_base64(32)
-    salt = _gen_base64(32)
+    # token_urlsafe emits base64url in one call; its alphabet is safe inside
+    # the double-quoted .env values below.
+    nextauth_secret = secrets.token_urlsafe(32)
+    salt = secrets.token_urlsafe(32)
     encryption_key = _gen_hex(32)  # 64 hex chars
 
-    postgres_password = _gen_base64(24)
-    redis_auth = _gen_base64(24)
-    clickhouse_password = _gen_base64(24)
-    minio_root_password = _gen_base64(24)
+    postgres_password = secrets.token_urlsafe(24)
+    redis_auth = secrets.token_urlsafe(24)
+    clickhouse_password = secrets.token_urlsafe(24)
+    minio_root_password = secrets.token_urlsafe(24)
 
     minio_root_user = "minio"
 
@@ -186,9 +195,10 @@ def main() -> int:
     if not DEPLOY_DIR.exists():
         raise SystemExit(f"Missing deploy dir: {DEPLOY_DIR}")
 
-    # Local DNS sanity check (helps catch obvious issues early).
-    web_ip = _resolve_a(cfg.domain_web)
-    s3_ip = _resolve_a(cfg.domain_s3)
+    # Local DNS sanity check (helps catch obvious issues early). The two
+    # lookups are independent; resolve them concurrently.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        web_ip, s3_ip = ex.map(_resolve_a, [cfg.domain_web, cfg.domain_s3])
     if web_ip and web_ip != cfg.host:
         print(f"[warn] {cfg.domain_web} resolves to {web_ip}, expected {cfg.host}")
     if s3_ip and s3_ip != cfg.host:
@@ -202,13 +212,19 @@ def main() -> int:
     compose_bytes = _read_file(DEPLOY_DIR / "docker-compose.yml")
     caddyfile_bytes = _read_file(DEPLOY_DIR / "Caddyfile")
 
-    # Replace hardcoded domains in Caddyfile, in case user changed them via env vars.
-    caddy_text = caddyfile_bytes.decode("utf-8")
-    caddy_text = caddy_text.replace("langfuse.omniforge.com.br", cfg.domain_web)
-    caddy_text = caddy_text.replace("s3.langfuse.omniforge.com.br", cfg.domain_s3)
+    # Replace hardcoded domains in Caddyfile, in case user changed them via
+    # env vars. One alternation pass; the s3. host is listed first so the
+    # longer match wins over its 'langfuse.*' suffix (the old sequential
+    # replace() calls depended on ordering for the same reason).
+    mapping = {
+        "s3.langfuse.omniforge.com.br": cfg.domain_s3,
+        "langfuse.omniforge.com.br": cfg.domain_web,
+    }
+    pat = re.compile("|".join(map(re.escape, mapping)))
+    caddy_text = pat.sub(lambda m: mapping[m.group(0)], caddyfile_bytes.decode("utf-8"))
     caddyfile_bytes = caddy_text.encode("utf-8")
 
-    with SSH(cfg.host, cfg.user, cfg.password) as ssh:
+    with PooledSSH(cfg.host, cfg.user, cfg.password) as ssh:
         # Basic info
         _, os_info_out, _ = ssh.run(
             "set -euo pipefail; uname -a; echo '---'; cat /etc/os-release",
@@ -217,88 +233,46 @@ def main() -> int:
         if os_info_out.strip():
             print(os_info_out.strip())
 
-        # Identify distro early (also lets us fix a broken Docker APT source from previous runs).
-        _, distro_out, _ = ssh.run(
-            "set -euo pipefail; . /etc/os-release; echo \"$ID\"; echo \"$VERSION_CODENAME\"",
-            check=True,
-        )
-        parts = [p.strip() for p in distro_out.splitlines() if p.strip()]
-        distro_id = parts[0] if len(parts) > 0 else ""
-        distro_codename = parts[1] if len(parts) > 1 else ""
-
-        # Clean up any wrong Docker repo config that would break apt-get update.
-        if distro_id == "debian":
-            ssh.run(
-                "set -euo pipefail; "
-                "if [ -f /etc/apt/sources.list.d/docker.list ] && "
-                "grep -q 'download.docker.com/linux/ubuntu' /etc/apt/sources.list.d/docker.list; then "
-                "rm -f /etc/apt/sources.list.d/docker.list; "
-                "fi"
-            )
-        if distro_id == "ubuntu":
-            ssh.run(
-                "set -euo pipefail; "
-                "if [ -f /etc/apt/sources.list.d/docker.list ] && "
-                "grep -q 'download.docker.com/linux/debian' /etc/apt/sources.list.d/docker.list; then "
-                "rm -f /etc/apt/sources.list.d/docker.list; "
-                "fi"
-            )
-
-        # Ensure base tools
-        ssh.run(
-            "set -euo pipefail; "
-            "apt-get update -y && "
-            "DEBIAN_FRONTEND=noninteractive apt-get install -y ca-certificates curl gnupg openssl ufw"
-        )
-
-        # Firewall: allow SSH + HTTP(S)
-        ssh.run("set -euo pipefail; ufw allow OpenSSH || true")
-        ssh.run("set -euo pipefail; ufw allow 80/tcp || true")
-        ssh.run("set -euo pipefail; ufw allow 443/tcp || true")
-        ssh.run("set -euo pipefail; ufw --force enable || true", check=False)
-
-        # Install Docker if missing (Debian/Ubuntu).
-        _, docker_rc_out, _ = ssh.run(
-            "set -euo pipefail; command -v docker >/dev/null 2>&1; echo $?",
+        # Provision in one round-trip: the whole decision tree (distro
+        # detection, Docker APT source cleanup, base tools, firewall, Docker
+        # install) runs remotely instead of as ~8 sequential exec channels.
+        rc, _, provision_err = ssh.run_script(_PROVISION_SCRIPT, check=False)
+        if rc == _RC_UNSUPPORTED_DISTRO:
+            raise SystemExit(provision_err.strip() or "Unsupported distro for automatic Docker install")
+        if rc != 0:
+            raise RuntimeError(f"Provisioning script failed ({rc}):\n{provision_err}".strip())
+
+        # Upload files, skipping any whose remote copy already matches (one
+        # sha256sum round-trip covers both paths). The .env is excluded: it is
+        # regenerated with fresh secrets every run.
+        uploads = {
+            "/opt/langfuse/docker-compose.yml": (compose_bytes, 0o644),
+            "/opt/langfuse/Caddyfile": (caddyfile_bytes, 0o644),
+        }
+        _, sums_out, _ = ssh.run(
+            f"sha256sum {' '.join(uploads)} 2>/dev/null || true",
             check=False,
         )
-        docker_missing = docker_rc_out.strip() != "0"
-
-        if docker_missing:
-            if distro_id not in ("debian", "ubuntu") or not distro_codename:
-                raise SystemExit(
-                    f"Unsupported distro for automatic Docker install (id={distro_id!r}, codename={distro_codename!r})"
-                )
-            docker_repo_os = "debian" if distro_id == "debian" else "ubuntu"
-
-            ssh.run(
-                "set -euo pipefail; "
-                "install -m 0755 -d /etc/apt/keyrings; "
-                f"curl -fsSL https://download.docker.com/linux/{docker_repo_os}/gpg | gpg --dearmor --batch --yes --no-tty -o /etc/apt/keyrings/docker.gpg; "
-                "chmod a+r /etc/apt/keyrings/docker.gpg; "
-                "echo "
-                f"\"deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.gpg] https://download.docker.com/linux/{docker_repo_os} "
-                f"{distro_codename} stable\" "
-                "> /etc/apt/sources.list.d/docker.list; "
-                "apt-get update -y; "
-                "DEBIAN_FRONTEND=noninteractive apt-get install -y docker-ce docker-ce-cli containerd.io docker-compose-plugin; "
-                "systemctl enable --now docker"
-            )
-
-        # Prepare /opt/langfuse
-        ssh.run("set -euo pipefail; mkdir -p /opt/langfuse; chmod 0755 /opt/langfuse")
-
-        # Upload files
-        ssh.put_bytes("/opt/langfuse/docker-compose.yml", compose_bytes, mode=0o644)
-        ssh.put_bytes("/opt/langfuse/Caddyfile", caddyfile_bytes, mode=0o644)
-        ssh.put_bytes("/opt/langfuse/.env", env_bytes, mode=0o600)
-
-        # Pull & start
-        ssh.run("set -euo pipefail; cd /opt/langfuse; docker compose pull")
-        ssh.run("set -euo pipefail; cd /opt/langfuse; docker compose up -d")
-
-        # Quick status
-        ssh.run("set -euo pipefail; cd /opt/langfuse; docker compose ps", check=False)
+        remote_sums = {}
+        for line in sums_out.splitlines():
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                remote_sums[parts[1].strip()] = parts[0]
+        for path, (content, mode) in uploads.items():
+            if remote_sums.get(path) == hashlib.sha256(content).hexdigest():
+                print(f"[skip] {path} unchanged")
+                continue
+            ssh.put_bytes(path, content, mode=mode)
+        # The .env is sub-kilobyte; stream it over an exec channel instead of
+        # paying the SFTP subsystem negotiation.
+        ssh.write_file_via_exec("/opt/langfuse/.env", env_bytes, mode=0o600)
+
+        # Pull & start, then a quick status — one persistent shell for the
+        # whole compose sequence instead of a channel per command.
+        with ssh.open_shell(cwd="/opt/langfuse") as shell:
+            shell.run("docker compose pull")
+            shell.run("docker compose up -d")
+            shell.run("docker compose ps", check=False)
 
     print("[ok] Langfuse stack deployed to /opt/langfuse")
     print("[note] Secrets were generated and stored in /opt/langfuse/.env on the VPS.")
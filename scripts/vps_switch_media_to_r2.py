@@ -1,11 +1,16 @@
 import os
 import re
-import sys
-import time
 from dataclasses import dataclass
-from typing import Dict, Tuple
+from typing import Dict
 
-import paramiko
+from ssh_pool import PooledSSH
+
+
+# Compiled once at import; re.match(pattern_str, ...) re-looks-up the pattern
+# on every line otherwise.
+_ENV_KV_RE = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)\s*$")
+# Site headers sit at line start (modulo indent) and are not comments.
+_SITE_HDR_RE = re.compile(r"^[ \t]*([^\s{#][^\s{]*)[ \t]*\{[ \t]*\r?$", re.MULTILINE)
 
 
 @dataclass(frozen=True)
@@ -23,20 +28,17 @@ def _require_env(name: str) -> str:
 
 
 def _parse_env(content: str) -> Dict[str, str]:
-    out: Dict[str, str] = {}
-    for line in content.splitlines():
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
-        if "=" not in line:
-            continue
-        k, v = line.split("=", 1)
-        k = k.strip()
-        v = v.strip()
-        if len(v) >= 2 and ((v[0] == v[-1] == '"') or (v[0] == v[-1] == "'")):
-            v = v[1:-1]
-        out[k] = v
-    return out
+    def _clean(v: str) -> str:
+        if len(v) >= 2 and v[0] == v[-1] and v[0] in ('"', "'"):
+            return v[1:-1]
+        return v
+
+    return {
+        k.strip(): _clean(v.strip())
+        for line in content.splitlines()
+        if (s := line.strip()) and not s.startswith("#") and "=" in s
+        for k, v in [s.split("=", 1)]
+    }
 
 
 def _format_env(d: Dict[str, str], original: str) -> str:
@@ -48,7 +50,7 @@ def _format_env(d: Dict[str, str], original: str) -> str:
     lines = original.splitlines()
     out_lines = []
     for line in lines:
-        m = re.match(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)\s*$", line)
+        m = _ENV_KV_RE.match(line)
         if not m:
             out_lines.append(line)
             continue
@@ -68,65 +70,6 @@ def _format_env(d: Dict[str, str], original: str) -> str:
     return "\n".join(out_lines) + "\n"
 
 
-class SSH:
-    def __init__(self, vps: VPS):
-        self.vps = vps
-        self.client = None
-
-    def __enter__(self) -> "SSH":
-        c = paramiko.SSHClient()
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        c.connect(
-            self.vps.host,
-            username=self.vps.user,
-            password=self.vps.password,
-            timeout=20,
-            banner_timeout=20,
-            auth_timeout=20,
-        )
-        self.client = c
-        return self
-
-    def __exit__(self, exc_type, exc, tb) -> None:
-        if self.client:
-            self.client.close()
-            self.client = None
-
-    def run(self, cmd: str, check: bool = True) -> Tuple[int, str, str]:
-        stdin, stdout, stderr = self.client.exec_command(cmd)
-        out = stdout.read().decode("utf-8", errors="replace")
-        err = stderr.read().decode("utf-8", errors="replace")
-        rc = stdout.channel.recv_exit_status()
-        if check and rc != 0:
-            raise RuntimeError(f"Command failed ({rc}): {cmd}\n{err}".strip())
-        return rc, out, err
-
-    def get_text(self, remote_path: str) -> str:
-        sftp = self.client.open_sftp()
-        try:
-            with sftp.file(remote_path, "rb") as f:
-                return f.read().decode("utf-8", errors="replace")
-        finally:
-            sftp.close()
-
-    def put_text(self, remote_path: str, content: str, mode: int = 0o600) -> None:
-        b = content.encode("utf-8")
-        sftp = self.client.open_sftp()
-        try:
-            tmp = f"{remote_path}.tmp-{int(time.time())}"
-            with sftp.file(tmp, "wb") as f:
-                f.write(b)
-            sftp.chmod(tmp, mode)
-            # Some SFTP servers refuse to overwrite on rename; remove destination first.
-            try:
-                sftp.remove(remote_path)
-            except OSError:
-                pass
-            sftp.rename(tmp, remote_path)
-        finally:
-            sftp.close()
-
-
 def _strip_s3_vhost_from_caddyfile(caddyfile: str) -> str:
     """
     Remove the block for s3.langfuse.omniforge.com.br (or any `s3.<something>` host),
@@ -135,28 +78,46 @@ def _strip_s3_vhost_from_caddyfile(caddyfile: str) -> str:
     # Simple heuristic: remove any top-level block whose label starts with "s3.".
     # Caddyfile blocks look like:
     #   host { ... }
-    lines = caddyfile.splitlines()
+    # Single pass over the string: find each site header, scan forward counting
+    # braces to the block's end, and drop the slice when the label is s3.*.
     out = []
     i = 0
-    while i < len(lines):
-        line = lines[i]
-        m = re.match(r"^\s*(s3\.[^\s{]+)\s*\{\s*$", line)
+    n = len(caddyfile)
+    while i < n:
+        m = _SITE_HDR_RE.search(caddyfile, i)
         if not m:
-            out.append(line)
-            i += 1
-            continue
-        # skip until matching closing brace at same nesting level
+            out.append(caddyfile[i:])
+            break
+        # Scan from the header's opening brace to the matching close.
         depth = 0
-        # consume header
-        depth += line.count("{") - line.count("}")
-        i += 1
-        while i < len(lines) and depth > 0:
-            depth += lines[i].count("{") - lines[i].count("}")
-            i += 1
-        # also skip any blank line immediately following
-        while i < len(lines) and lines[i].strip() == "":
-            i += 1
-    return "\n".join(out).rstrip() + "\n"
+        j = caddyfile.index("{", m.start())
+        while j < n:
+            c = caddyfile[j]
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    break
+            j += 1
+        block_end = min(j + 1, n)
+        if m.group(1).startswith("s3."):
+            out.append(caddyfile[i : m.start()])
+            # Also skip any blank lines immediately following the block.
+            k = block_end
+            while k < n:
+                nl = caddyfile.find("\n", k)
+                if nl == -1:
+                    k = n if not caddyfile[k:].strip() else k
+                    break
+                if caddyfile[k:nl].strip():
+                    break
+                k = nl + 1
+            i = k
+        else:
+            out.append(caddyfile[i:block_end])
+            i = block_end
+    return "".join(out).rstrip() + "\n"
 
 
 def main() -> int:
@@ -174,7 +135,7 @@ def main() -> int:
     # Cloudflare docs: presigned URLs must use <ACCOUNT_ID>.r2.cloudflarestorage.com (not custom domains).
     r2_endpoint = f"https://{r2_account_id}.r2.cloudflarestorage.com"
 
-    with SSH(vps) as ssh:
+    with PooledSSH(vps.host, vps.user, vps.password) as ssh:
         env_path = "/opt/langfuse/.env"
         caddy_path = "/opt/langfuse/Caddyfile"
 
@@ -194,18 +155,20 @@ def main() -> int:
 
         env_vars.update(updates)
         new_env_text = _format_env(env_vars, env_text)
-        ssh.put_text(env_path, new_env_text, mode=0o600)
+        ssh.write_file_via_exec(env_path, new_env_text.encode("utf-8"), mode=0o600)
 
         # Remove s3.* vhost from Caddyfile to stop ACME retries.
         caddy_text = ssh.get_text(caddy_path)
         new_caddy_text = _strip_s3_vhost_from_caddyfile(caddy_text)
         if new_caddy_text != caddy_text:
-            ssh.put_text(caddy_path, new_caddy_text, mode=0o644)
-
-        # Restart to pick up env changes.
-        ssh.run("set -euo pipefail; cd /opt/langfuse; docker compose up -d")
-        ssh.run("set -euo pipefail; cd /opt/langfuse; docker compose restart caddy langfuse-web langfuse-worker")
-        ssh.run("set -euo pipefail; cd /opt/langfuse; docker compose ps", check=False)
+            ssh.write_file_via_exec(caddy_path, new_caddy_text.encode("utf-8"), mode=0o644)
+
+        # Restart to pick up env changes; one persistent shell for the
+        # compose sequence instead of a channel per command.
+        with ssh.open_shell(cwd="/opt/langfuse") as shell:
+            shell.run("docker compose up -d")
+            shell.run("docker compose restart caddy langfuse-web langfuse-worker")
+            shell.run("docker compose ps", check=False)
 
     print("[ok] Switched LANGFUSE media storage to Cloudflare R2.")
     print("[next] Configure CORS on the R2 bucket to allow browser PUT from https://langfuse.omniforge.com.br.")